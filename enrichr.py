@@ -1,170 +1,724 @@
-from typing import List
-from pydantic import BaseModel
-from model import is_initialized, get_llm
+from dataclasses import dataclass, fields, replace
+from typing import Iterator, List
+from pydantic import BaseModel, TypeAdapter
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+import logging
+import re
+import sys
+import threading
+from model import is_initialized, acquire_llm, pool_size
+from semantic_cache import get_cache
+
+logger = logging.getLogger(__name__)
 
 class ChatMessageInput(BaseModel):
     role: str
     content: str
 
+# Serializes a whole message list to plain dicts in one pydantic-core call
+_MESSAGES_ADAPTER = TypeAdapter(List[ChatMessageInput])
+
+@dataclass(frozen=True, slots=True)
+class GenConfig:
+    """
+    Generation and routing settings used on the request path.
+
+    Immutable, so one instance is shared by every request thread; derive
+    per-call overrides with dataclasses.replace().
+    """
+    temperature: float = 0.6
+    top_p: float = 0.95
+    max_tokens: int = 32768
+    enrich_max_tokens: int = 1024
+    expert_max_tokens: int = 512
+    enrich: bool = True
+    enrich_min_chars: int = 40
+    enrich_max_lines: int = 3
+    expert_router: bool = True
+    expert_min_words: int = 15
+    speculative_expert: bool = False
+    speculative_min_overlap: float = 0.5
+    deep_mode: bool = False
+
+# Static prompt templates. These are plain strings split once at import around
+# their placeholders, so each call is a concatenation rather than a .format() parse.
+# The enrich and expert templates keep the variable text at the very end so the
+# long static scaffold is a shared prefix llama.cpp can reuse from its KV cache.
+
+# Prompt template to refine the user's request
+ENRICH_TEMPLATE = """<prompt>
+  <task>Rewrite the sample prompt given at the end into a clearer, more specific and more complete prompt that will elicit a detailed, insightful response. Do not answer it.</task>
+  <steps>
+    <step>Identify the user's core request and underlying goal.</step>
+    <step>Note any assumptions, ambiguities or missing context.</step>
+    <step>Consider specificity, level of detail, scope, desired output format and relevant perspectives.</step>
+    <step>Add elaborations and follow-up questions that resolve the ambiguities and cover related aspects.</step>
+  </steps>
+  <rules>
+    <rule>Reflect inside `<think>` tags.</rule>
+    <rule>After the `<think>` block, write only the refined prompt, opening it with a `<refined_prompt>` tag and closing it with the matching end tag.</rule>
+    <rule>Do not invent information or introduce external knowledge. Enrich the prompt, do not answer it.</rule>
+  </rules>
+</prompt>
+
+BELOW IS THE SAMPLE PROMPT:
+
+{user_request}
+"""
+
+# Prompt template to generate expert persona
+EXPERT_TEMPLATE = """<prompt>
+  <task>Analyze the sample prompt given at the end to determine who is best placed to answer it.</task>
+  <steps>
+    <step>Determine the primary domain or subject area of the prompt.</step>
+    <step>Choose the ONE type of expert best qualified to answer it, someone who could teach an advanced course on the subject (e.g. a software engineer specializing in Python), and justify the choice from the prompt's content.</step>
+  </steps>
+  <rules>
+    <rule>Do not hallucinate. If you are uncertain about something, say so.</rule>
+    <rule>Respond with nothing but your analysis, starting with a `<reflection_points>` tag.</rule>
+    <rule>Inside it, first give the domain in a `<domain>` element, then the expert followed by "(Justification: ...)" in an `<ideal_expert>` element.</rule>
+    <rule>Close every element with its matching end tag.</rule>
+  </rules>
+</prompt>
+
+BELOW IS THE SAMPLE PROMPT:
+
+{context}
+"""
+
+# Static instructions for the deep-mode final call. They are sent as a system
+# message ahead of the chat history, so this part of the final prompt is a
+# prefix shared by every request and restored from the KV cache.
+FINAL_SYSTEM_PROMPT = """<prompt>
+  <context>
+    <description>You are tasked with providing a detailed explanation to the user's inquiry. Please focus on the core mechanisms and key aspects.</description>
+    <llm_guidance>As a smaller language model, we understand that your resources are limited. Therefore, we aim to provide a clear and concise prompt to help you deliver the best possible response.</llm_guidance>
+  </context>
+  <objective>
+    <goal>To generate a comprehensive and accurate explanation that demonstrates a strong understanding of its fundamental principles.</goal>
+  </objective>
+  <specificity>
+    <format_preference>Please structure your explanation in clear paragraphs, using bullet points if helpful to list key features or steps.</format_preference>
+  </specificity>
+  <resources_constraints>
+    <efficiency_focus>Please be as concise as possible while ensuring sufficient detail.</efficiency_focus>
+    <accuracy_emphasis>
+      <warning>
+        **It is absolutely critical that the information you provide is accurate and based on verifiable knowledge. Please do not generate or include any information that is fabricated, speculative, or constitutes a hallucination.** 
+      </warning>
+      <instruction>If you are uncertain about any aspect of the topic, please explicitly state your uncertainty rather than providing potentially incorrect information. </instruction>
+    </accuracy_emphasis>
+    <output_format_constraint>Your response should be formatted in well-structured paragraphs, potentially using bullet points for lists. Tables are also an option, if relevant and useful to the topic.</output_format_constraint>
+  </resources_constraints>
+  <reward_system>
+    <positive_reinforcement>A highly detailed, accurate, and well-explained response that adheres to these instructions and avoids any hallucinations will be considered a top-quality result. Such a response will be greatly appreciated and acknowledged as an excellent demonstration of your capabilities.</positive_reinforcement> 
+    <quality_criteria>Key indicators of a high-quality response include:</quality_criteria>
+    <ul>
+      <li>Demonstrated in-depth understanding of the topic.</li>
+      <li>Accuracy of all provided information.</li>
+      <li>Clarity and logical flow of the explanation.</li>
+      <li>Appropriate level of detail without being overly verbose.</li>
+      <li>Complete absence of hallucinations or fabricated information.</li>
+    </ul>
+  </reward_system>
+</prompt>"""
+
+# Prompt template combining the enriched request and expert persona
+FINAL_TEMPLATE = """<prompt>
+  <persona>
+    {expert_persona}
+  </persona>
+  <task>
+    <action>Explain in detail the following:</action>
+    <topic>{enriched_content}</topic>
+  </task>
+</prompt>"""
+
+def _compact(template: str) -> str:
+    """Drop the indentation and blank lines that keep the templates readable here but cost prefill tokens."""
+    return re.sub(r"\n\s+", "\n", template)
+
+ENRICH_TEMPLATE = _compact(ENRICH_TEMPLATE)
+EXPERT_TEMPLATE = _compact(EXPERT_TEMPLATE)
+FINAL_SYSTEM_PROMPT = _compact(FINAL_SYSTEM_PROMPT)
+FINAL_TEMPLATE = _compact(FINAL_TEMPLATE)
+
+_ENRICH_PREFIX, _, _ENRICH_SUFFIX = ENRICH_TEMPLATE.partition("{user_request}")
+_EXPERT_PREFIX, _, _EXPERT_SUFFIX = EXPERT_TEMPLATE.partition("{context}")
+_FINAL_HEAD, _, _final_rest = FINAL_TEMPLATE.partition("{expert_persona}")
+_FINAL_MIDDLE, _, _FINAL_TAIL = _final_rest.partition("{enriched_content}")
+
+# System prompt for the default single-call mode, which folds the enrich, expert
+# and final stages into one generation
+SINGLE_CALL_PROMPT = """<prompt>
+  <task>Answer the user's latest message as well as possible.</task>
+  <steps>
+    <step>Inside `<think>` tags, reflect on what the user is really asking: their underlying goal, any ambiguities or missing context, and the level of detail and format that would help them most.</step>
+    <step>Still inside `<think>`, decide which ONE type of expert is best qualified to answer, and adopt that expert's perspective.</step>
+    <step>After the `<think>` block, write your answer as that expert, opening it with an `<answer>` tag and closing it with the matching end tag.</step>
+  </steps>
+  <rules>
+    <rule>Structure the answer in clear paragraphs, using bullet points or tables where they help.</rule>
+    <rule>Be as concise as possible while giving sufficient detail.</rule>
+    <rule>Only state accurate, verifiable information. If you are uncertain about something, say so rather than guessing.</rule>
+  </rules>
+</prompt>"""
+SINGLE_CALL_PROMPT = _compact(SINGLE_CALL_PROMPT)
+
+# Persona used when the router skips generate_expert()
+GENERIC_PERSONA = "A knowledgeable, helpful assistant with broad expertise who answers clearly and accurately."
+
+# Reasoning blocks, stripped from a single-call response whose answer tags are missing
+_THINK_RE = re.compile(r"<think>.*?(?:</think>|\Z)", re.DOTALL)
+
+# Words of four or more letters, used to check speculative expert generation
+_WORD_RE = re.compile(r"[a-z0-9]{4,}")
+
+# Token ids of the chat-formatted enrich and expert templates, split around the
+# user text as (prefix, suffix). Filled by prepare_prompts().
+_prompt_tokens = {}
 
-def enrich_request(messages: List[ChatMessageInput], config: dict = None) -> tuple[List['ChatMessageInput'], str]:
-    """Process a chat request using the initialized model."""
+# LRU cache of refined prompts, see _enrich_content()
+ENRICH_CACHE_SIZE = 1024
+_enrich_cache = OrderedDict()
+_enrich_cache_lock = threading.Lock()
+# Enrichment calls in progress by cache key, so concurrent identical requests share one call
+_enrich_inflight = {}
+
+# Greedy sampling for the enrichment call. Refinement is a structured rewrite
+# rather than creative output, and deterministic results can always be cached.
+ENRICH_SAMPLER = {
+    "temperature": 0.0,
+    "top_p": 1.0,
+    "top_k": 1,
+    "repeat_penalty": 1.0,
+    "mirostat_mode": 0,
+}
+
+# Runs speculative expert stages beside the enrichment in the request thread,
+# one worker per model handle. Created by prepare_prompts() once the pool exists.
+_stage_executor = None
+
+
+def load_settings(config: dict = None) -> GenConfig:
+    """
+    Resolve the settings used on the request path from the raw configuration once.
+
+    Args:
+        config: The configuration loaded from config.yaml
+
+    Returns:
+        The generation and routing settings, with defaults for missing keys
+    """
+    config = config or {}
+    settings = GenConfig(**{field.name: config[field.name] for field in fields(GenConfig) if field.name in config})
+    # The stage budgets never exceed the overall limit
+    return replace(
+        settings,
+        enrich_max_tokens=min(settings.enrich_max_tokens, settings.max_tokens),
+        expert_max_tokens=min(settings.expert_max_tokens, settings.max_tokens),
+    )
+
+DEFAULT_SETTINGS = load_settings()
+
+def prepare_prompts() -> None:
+    """
+    Tokenize the static enrich and expert templates once, wrapped in the model's chat template,
+    and size the speculative stage executor to the model pool.
+
+    Must be called after model.initialize() and before handling requests.
+    """
+    global _stage_executor
+    _stage_executor = ThreadPoolExecutor(max_workers=pool_size(), thread_name_prefix="expert")
+    with acquire_llm() as llm:
+        _prompt_tokens["enrich"] = _tokenize_template(llm, _ENRICH_PREFIX, _ENRICH_SUFFIX)
+        _prompt_tokens["expert"] = _tokenize_template(llm, _EXPERT_PREFIX, _EXPERT_SUFFIX)
+    print(f"Prepared prompt templates ({len(_prompt_tokens['enrich'][0])} and "
+          f"{len(_prompt_tokens['expert'][0])} prefix tokens)")
+
+def _tokenize_template(llm, prefix: str, suffix: str) -> tuple[List[int], List[int]]:
+    """
+    Render a template as a single user chat turn and tokenize the parts around the user text.
+
+    Args:
+        llm: The model whose tokenizer and chat template to use
+        prefix: Template text before the user text
+        suffix: Template text after the user text
+
+    Returns:
+        A tuple of (prefix token ids, suffix token ids)
+    """
+    marker = "\x00USER_TEXT\x00"
+    chat_template = llm.metadata.get("tokenizer.chat_template")
+    if chat_template is None:
+        print("Warning: Model has no chat template; using the raw prompt templates.", file=sys.stderr)
+        return (llm.tokenize(prefix.encode("utf-8"), add_bos=True, special=True),
+                llm.tokenize(suffix.encode("utf-8"), add_bos=False, special=True))
+
+    formatter = Jinja2ChatFormatter(
+        template=chat_template,
+        eos_token=llm.detokenize([llm.token_eos()], special=True).decode("utf-8", errors="ignore"),
+        bos_token=llm.detokenize([llm.token_bos()], special=True).decode("utf-8", errors="ignore"),
+    )
+    rendered = formatter(messages=[{"role": "user", "content": prefix + marker + suffix}]).prompt
+    head, _, tail = rendered.partition(marker)
+    # The chat template emits its own BOS text, so special tokens are parsed and none is added
+    return (llm.tokenize(head.encode("utf-8"), add_bos=False, special=True),
+            llm.tokenize(tail.encode("utf-8"), add_bos=False, special=True))
+
+def enrich_request(messages: List[ChatMessageInput], config: GenConfig = DEFAULT_SETTINGS) -> tuple[List['ChatMessageInput'], str]:
+    """Process a chat request using the initialized model, serving semantic duplicates from the cache."""
     if not is_initialized():
         raise RuntimeError("Model not initialized. Call initialize() first.")
-    
+
+    cache = get_cache()
+    latest_message = messages[-1].content if len(messages) > 0 else ""
+    context = _history_key(messages)
+    if cache is not None and latest_message:
+        # Embedded once; a miss reuses the vector when the response is cached
+        vector = cache.embed(latest_message)
+        cached = cache.lookup(latest_message, context, vector)
+        if cached is not None:
+            # Only the response is cached; there are no formatted messages to return
+            return None, cached
+
+    formatted_messages, error_message = _build_messages(messages, config)
+    if formatted_messages is None:
+        return None, error_message
+
+    # Get response from model
+    with acquire_llm() as llm:
+        response = llm.create_chat_completion(
+            messages=formatted_messages,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            max_tokens=config.max_tokens,
+            stop=None if config.deep_mode else ["</answer>"],
+        )
+
+    # Combine expert persona with model response
+    model_response = response["choices"][0]["message"]["content"]
+    if not config.deep_mode:
+        model_response = _extract_answer(model_response)
+
+    # Only cache completed pipeline runs with an answer, not the early-exit messages
+    if cache is not None and latest_message and model_response.strip():
+        cache.add(latest_message, model_response, context, vector)
+
+    return formatted_messages, model_response
+
+def stream_enrich_request(messages: List[ChatMessageInput], config: GenConfig = DEFAULT_SETTINGS) -> Iterator[str]:
+    """
+    Process a chat request like enrich_request(), yielding the final response as it is generated.
+
+    Args:
+        messages: The chat messages of the request
+        config: Settings from load_settings()
+
+    Yields:
+        Pieces of the final model response, in order
+    """
+    if not is_initialized():
+        raise RuntimeError("Model not initialized. Call initialize() first.")
+
+    cache = get_cache()
+    latest_message = messages[-1].content if len(messages) > 0 else ""
+    context = _history_key(messages)
+    if cache is not None and latest_message:
+        # Embedded once; a miss reuses the vector when the response is cached
+        vector = cache.embed(latest_message)
+        cached = cache.lookup(latest_message, context, vector)
+        if cached is not None:
+            yield cached
+            return
+
+    formatted_messages, error_message = _build_messages(messages, config)
+    if formatted_messages is None:
+        yield error_message
+        return
+
+    parts = []
+    with acquire_llm() as llm:
+        chunks = llm.create_chat_completion(
+            messages=formatted_messages,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            max_tokens=config.max_tokens,
+            stop=None if config.deep_mode else ["</answer>"],
+            stream=True,
+        )
+        try:
+            texts = _delta_texts(chunks)
+            if not config.deep_mode:
+                texts = _stream_answer(texts)
+            for text in texts:
+                parts.append(text)
+                yield text
+        finally:
+            # Stop generation before the handle goes back to the pool
+            chunks.close()
+
+    # Only reached when the response streamed to completion
+    model_response = "".join(parts)
+    if cache is not None and latest_message and model_response.strip():
+        cache.add(latest_message, model_response, context, vector)
+
+def _history_key(messages: List[ChatMessageInput]) -> str:
+    """Flatten the conversation before the latest message, including any system prompt, into a cache context."""
+    return "\x00".join(f"{msg.role}\x01{msg.content}" for msg in messages[:-1])
+
+def _build_messages(messages: List[ChatMessageInput], config: GenConfig = DEFAULT_SETTINGS) -> tuple[List[dict], str]:
+    """
+    Build the messages for the final LLM call in the configured mode.
+
+    In the default single-call mode the model reflects, picks a persona and
+    answers in one generation. In deep mode the separate enrich and expert
+    stages run first.
+
+    Args:
+        messages: The chat messages of the request
+        config: Settings from load_settings()
+
+    Returns:
+        A tuple of (formatted messages, None), or (None, reason) if a deep-mode stage produced nothing
+    """
+    if config.deep_mode:
+        return _build_final_messages(messages, config)
+    return _with_system_prompt(SINGLE_CALL_PROMPT, _MESSAGES_ADAPTER.dump_python(messages)), None
+
+def _with_system_prompt(system_prompt: str, history: List[dict]) -> List[dict]:
+    """
+    Put the pipeline's instructions at the start of the conversation as its only leading system turn.
+
+    A client system prompt is merged into the same message rather than sent as a
+    second system turn, which chat templates that alternate roles reject. The
+    instructions come first, so they stay a prefix shared across requests.
+
+    Args:
+        system_prompt: The static instructions for the call
+        history: The client's messages as dicts
+
+    Returns:
+        The messages for the call
+    """
+    if history and history[0]["role"] == "system":
+        merged = {"role": "system", "content": f"{system_prompt}\n\n{history[0]['content']}"}
+        return [merged] + history[1:]
+    return [{"role": "system", "content": system_prompt}] + history
+
+def _delta_texts(chunks: Iterator[dict]) -> Iterator[str]:
+    """Yield the content pieces of a streamed chat completion."""
+    for chunk in chunks:
+        text = chunk["choices"][0]["delta"].get("content")
+        if text:
+            yield text
+
+def _extract_answer(response_text: str) -> str:
+    """
+    Return the content of the first <answer> tag outside a <think> block, like _stream_answer().
+
+    Tags the model mentions while thinking are skipped, while the answer itself
+    is returned verbatim, even if it talks about these tags. Without an answer
+    tag, the response minus its <think> blocks is returned.
+    """
+    scan_from = 0
+    while True:
+        think = response_text.find("<think>", scan_from)
+        start = response_text.find("<answer>", scan_from)
+        if start != -1 and (think == -1 or start < think):
+            return _tag_content(response_text, start + len("<answer>"), ("</answer>",))
+        if think == -1:
+            break
+        end = response_text.find("</think>", think)
+        if end == -1:
+            break
+        scan_from = end + len("</think>")
+    return _THINK_RE.sub("", response_text).strip()
+
+def _stream_answer(texts: Iterator[str]) -> Iterator[str]:
+    """
+    Filter a streamed single-call response down to the content of its <answer> tag.
+
+    Text up to the opening tag, including any <think> block, is held back;
+    everything after it is passed through as it arrives (the closing tag is a
+    stop sequence, so it never does).
+
+    Args:
+        texts: The content pieces of the streamed response
+
+    Yields:
+        Pieces of the answer, in order
+    """
+    buffer = ""
+    scan_from = 0
+    thinking = False
+    in_answer = False
+    for text in texts:
+        if in_answer:
+            yield text
+            continue
+        buffer += text
+        while True:
+            if thinking:
+                end = buffer.find("</think>", scan_from)
+                if end == -1:
+                    break
+                thinking = False
+                scan_from = end + len("</think>")
+                continue
+            think = buffer.find("<think>", scan_from)
+            start = buffer.find("<answer>", scan_from)
+            if start != -1 and (think == -1 or start < think):
+                in_answer = True
+                rest = buffer[start + len("<answer>"):]
+                if rest:
+                    yield rest
+                break
+            if think == -1:
+                break
+            thinking = True
+            scan_from = think + len("<think>")
+        # Rescan only the new text, plus enough of the old to catch a tag split across pieces
+        scan_from = max(scan_from, len(buffer) - len("</think>"))
+    if not in_answer and buffer:
+        # The model skipped the answer tags; fall back to everything outside <think>
+        yield _extract_answer(buffer)
+
+def _build_final_messages(messages: List[ChatMessageInput], config: GenConfig = DEFAULT_SETTINGS) -> tuple[List[dict], str]:
+    """
+    Run the enrich and expert stages and build the messages for the final LLM call.
+
+    Args:
+        messages: The chat messages of the request
+        config: Settings from load_settings()
+
+    Returns:
+        A tuple of (formatted messages, None), or (None, reason) if a stage produced nothing
+    """
     # Format messages for the model
-    formatted_messages = [{"role": msg.role, "content": msg.content} for msg in messages[:-1]]
+    formatted_messages = _with_system_prompt(FINAL_SYSTEM_PROMPT, _MESSAGES_ADAPTER.dump_python(messages[:-1]))
 
-    enriched_content = _enrich_content(messages[-1].content, config) if len(messages) > 0 else ""
+    latest_message = messages[-1].content if len(messages) > 0 else ""
+    expert_persona = None
+    if latest_message and not _needs_expert(latest_message, config):
+        logger.debug("Skipping expert generation for a short request")
+        expert_persona = GENERIC_PERSONA
+        enriched_content = _enrich_content(latest_message, config)
+    elif latest_message and config.speculative_expert and pool_size() > 1:
+        enriched_content, expert_persona = _run_speculative_stages(latest_message, config)
+    else:
+        enriched_content = _enrich_content(latest_message, config) if len(messages) > 0 else ""
     if not enriched_content.strip():
-        print("No enriched content generated. Returning original message.")
+        logger.warning("No enriched content generated. Returning original message.")
         return None, "No enriched content generated. Returning original message."
     
     # Generate expert persona based on enriched content
-    expert_persona = generate_expert(enriched_content, config)
+    if expert_persona is None:
+        expert_persona = generate_expert(enriched_content, config)
     if not expert_persona.strip():
-        print("No expert persona generated. Returning enriched content.")
+        logger.warning("No expert persona generated. Returning enriched content.")
         return None, "No expert persona generated. Returning enriched content."
     
     final_prompt = build_final_prompt(enriched_content, expert_persona)
     formatted_messages.append({"role": messages[-1].role, "content": final_prompt})
-    
-    # Get response from model
-    llm = get_llm()
-    response = llm.create_chat_completion(
-        messages=formatted_messages,
-        temperature=config.get('temperature', 0.6) if config else 0.6,
-        top_p=config.get('top_p', 0.95) if config else 0.95,
-        max_tokens=config.get('max_tokens', 32768) if config else 32768,
-    )
-    
-    # Combine expert persona with model response
-    model_response = response["choices"][0]["message"]["content"]
+    return formatted_messages, None
 
-    return formatted_messages, model_response
+def _collect_stream(chunks: Iterator[dict]) -> str:
+    """
+    Accumulate a streamed completion that ends at a native stop sequence.
+
+    llama.cpp checks the stop strings in its sampling loop and strips them
+    from the output, so no tag scanning is needed on this side; the stream
+    is only closed early if the consumer fails.
+
+    Args:
+        chunks: The stream returned by create_completion(stream=True)
+
+    Returns:
+        The text generated before the stop sequence
+    """
+    try:
+        return "".join(chunk["choices"][0]["text"] for chunk in chunks)
+    finally:
+        # Abort the remaining generation
+        chunks.close()
+
+def _needs_enrichment(latest_message: str, config: GenConfig = DEFAULT_SETTINGS) -> bool:
+    """
+    Decide whether a request is worth the enrichment call.
+
+    Very short messages ("hi", "thanks") have nothing to elaborate on, and
+    messages spread over several lines are usually already structured
+    prompts, so both are used as they are.
+
+    Args:
+        latest_message: The most recent user message
+        config: Settings from load_settings()
 
-def _enrich_content(latest_message: str, config: dict = None) -> str:
+    Returns:
+        True if _refine_prompt() should run for this request
+    """
+    if not config.enrich:
+        return False
+    return (len(latest_message) >= config.enrich_min_chars
+            and latest_message.count("\n") <= config.enrich_max_lines)
+
+def _needs_expert(latest_message: str, config: GenConfig = DEFAULT_SETTINGS) -> bool:
+    """
+    Decide whether a request is worth a dedicated expert persona.
+
+    Short requests that are not questions ("hi", "thanks", "write a haiku")
+    gain nothing from a tailored persona, so the expert call is skipped.
+
+    Args:
+        latest_message: The most recent user message
+        config: Settings from load_settings()
+
+    Returns:
+        True if generate_expert() should run for this request
+    """
+    if not config.expert_router:
+        return True
+    return "?" in latest_message or len(latest_message.split()) >= config.expert_min_words
+
+def _run_speculative_stages(latest_message: str, config: GenConfig) -> tuple[str, str]:
+    """
+    Run enrichment and expert generation concurrently on separate model handles.
+
+    The expert persona is generated speculatively from the raw user message. If
+    the enriched prompt drifts too far from it, the persona is regenerated from
+    the enriched prompt instead.
+
+    Args:
+        latest_message: The most recent user message
+        config: Settings from load_settings()
+
+    Returns:
+        A tuple of (enriched content, expert persona)
+    """
+    # Enrichment stays in this thread, so each request occupies one executor worker
+    expert_future = _stage_executor.submit(generate_expert, latest_message, config)
+    enriched_content = _enrich_content(latest_message, config)
+    expert_persona = expert_future.result()
+
+    if enriched_content.strip() and _word_overlap(latest_message, enriched_content) < config.speculative_min_overlap:
+        logger.info("Enriched content diverged from the original request. Regenerating expert persona.")
+        expert_persona = generate_expert(enriched_content, config)
+    return enriched_content, expert_persona
+
+def _word_overlap(original: str, enriched: str) -> float:
+    """Fraction of the original message's words that also appear in the enriched text."""
+    original_words = set(_WORD_RE.findall(original.lower()))
+    if not original_words:
+        return 1.0
+    enriched_words = set(_WORD_RE.findall(enriched.lower()))
+    return len(original_words & enriched_words) / len(original_words)
+
+def _enrich_content(latest_message: str, config: GenConfig = DEFAULT_SETTINGS) -> str:
     """
     Enhance the user's request by generating a refined prompt using the LLM.
+
+    Requests that _needs_enrichment() rejects are returned unchanged.
+
+    Enrichment samples greedily (ENRICH_SAMPLER), so refined prompts are kept in
+    an LRU cache keyed on the normalized message and token budget. Concurrent
+    requests for the same key wait on the first one's call instead of each
+    running their own.
     
     Args:
         latest_message: The most recent user message to enrich
-        config: Optional configuration for the LLM call
+        config: Settings from load_settings()
         
     Returns:
         The refined prompt extracted from the LLM response between &lt;refined_prompt&gt; tags
     """
     if not is_initialized():
         raise RuntimeError("Model not initialized. Call initialize() first.")
-    
-    # Internal prompt template to refine the user's request
-    prompt_template = """<prompt>
-    <greeting>Dear Language Model,</greeting>
-    <instruction>
-        <task>Please carefully follow these steps to reflect upon and enrich a given sample prompt. **Ensure that your reflection and intermediate thoughts during this process are enclosed within `<think>` XML tags in your response. The final enriched prompt should be placed outside of these tags.**</task>
-        <sub_task order="1">
-            <title>Understand the Core Request</title>
-            <description>First, take a moment to **fully read and deeply understand the central question or request** presented within the `<sample_prompt>` tag below. Identify the user's primary goal or information need.</description>
-        </sub_task>
-        <sub_task order="2">
-            <title>Reflect on Underlying Assumptions and Ambiguities</title>
-            <description>Next, **critically reflect on any underlying assumptions** that might be present in the sample prompt. Consider potential **ambiguities or different interpretations** the prompt could have. Think about what might be unclear or left unsaid.</description>
-        </sub_task>
-        <sub_task order="3">
-            <title>Brainstorm Related Concepts and Ideas</title>
-            <description>Now, **generate related concepts and ideas** that naturally extend from the core of the sample prompt. Think broadly and consider different facets or aspects that connect to the original request. What related areas might the user be interested in or might be important to consider?</description>
-        </sub_task>
-        <sub_task order="4">
-            <title>Identify Areas for Enrichment and Detail</title>
-            <description>**Pinpoint specific areas where the sample prompt could be enriched** with more detail, explanation, or context to elicit a more comprehensive and insightful response. Consider what additional information or perspective would be beneficial.</description>
-        </sub_task>
-        <sub_task order="5">
-            <title>Formulate Elaborations and Follow-Up Questions</title>
-            <description>**Develop specific elaborations or insightful follow-up questions** that could help to create a more complete and nuanced understanding of the topic initiated by the sample prompt. These should aim to address the ambiguities identified and explore the related concepts brainstormed.</description>
-        </sub_task>
-    </instruction>
-    <reflection_guidance>
-        <elaboration_help>To ensure your elaborations are broadly helpful and useful for enriching a wide range of prompts, consider the following aspects during your reflection (please include these considerations within your `<think>` block):</elaboration_help>
-        <ul>
-            <li>**Specificity:** Does the original prompt ask for something specific, or could it be narrowed down for a more focused answer? Think about including specific types of information, timeframes, locations, or criteria.</li>
-            <li>**Granularity:** Does the prompt ask for a high-level overview, or would a more detailed, fine-grained response be more valuable? Consider asking for mechanisms, processes, or specific examples.</li>
-            <li>**Context:** Is there any missing context that would help in understanding the user's underlying need? Think about the user's background, their intended use of the information, or the broader situation.</li>
-            <li>**Assumptions:** What assumptions might the original prompt be making? Are these assumptions valid, or should they be questioned or explored?</li>
-            <li>**Scope:** Is the scope of the prompt too broad or too narrow? Could it be adjusted to yield more manageable or more comprehensive results?</li>
-            <li>**Format:** Does the prompt imply a desired output format (e.g., a list, a comparison)? Could explicitly specifying a format improve the clarity or usefulness of the response?</li>
-            <li>**Perspective:** Would considering different perspectives or viewpoints enrich the understanding of the topic? Think about different stakeholders or roles.</li>
-            <li>**Underlying Goals:** What is the user really trying to achieve by asking this question? Understanding the underlying goal can help in tailoring the enriched prompt.</li>
-        </ul>
-    </reflection_guidance>
-    <hallucination_warning>
-        **Critical Warning:** Under no circumstances should you invent or hallucinate information that is not directly derived from a logical reflection on the provided sample prompt and the principles of effective prompt engineering. Your goal is to *enrich* the prompt, not to answer it or introduce external knowledge.
-    </hallucination_warning>
-    <reward_system>
-    **You will be recognized for:**
-      <reward>You will be considered to have provided a high-quality output if your refined prompt is significantly clearer, more specific, and more likely to elicit a detailed and insightful response compared to the original sample prompt. Your thoughtful reflection and the relevance of your elaborations will be highly valued.</reward>
-</reward>
-      <reward>Ensuring your response is correctly formatted within the `<think>` and `<refined_prompt>` XML structure.</reward>
-    **Accuracy and attention to detail will be highly rewarded in our assessment.**
-    </reward_system>
-    <sample_prompt>What are the main factors contributing to the success of a small local bookstore?</sample_prompt>
-    <refined_prompt>
-        <!-- The language model will generate the refined prompt here based on the above instructions, outside of the <think> tags -->
-    </refined_prompt>
-    <closing>Thank you for your thoughtful work!</closing>
-</prompt>
 
-BELOW IS THE SAMPLE PROMPT:
+    if not _needs_enrichment(latest_message, config):
+        logger.debug("Skipping enrichment for a short or already structured request")
+        return latest_message
 
-{user_request}
-"""
-    
-    # Format the prompt with the user's message
-    formatted_prompt = prompt_template.format(user_request=latest_message)
-    
+    key = (" ".join(latest_message.lower().split()), config.enrich_max_tokens)
+    with _enrich_cache_lock:
+        enriched = _enrich_cache.get(key)
+        if enriched is not None:
+            _enrich_cache.move_to_end(key)
+            logger.debug("Enrichment cache hit")
+            return enriched
+        pending = _enrich_inflight.get(key)
+        if pending is None:
+            pending = _enrich_inflight[key] = Future()
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        logger.debug("Waiting on an identical enrichment in progress")
+        return pending.result()
+
+    try:
+        enriched, tagged = _refine_prompt(latest_message, config)
+    except BaseException as e:
+        with _enrich_cache_lock:
+            del _enrich_inflight[key]
+        pending.set_exception(e)
+        raise
+    with _enrich_cache_lock:
+        del _enrich_inflight[key]
+        # Greedy sampling would repeat a failed refinement, so only a real one is kept
+        if tagged and enriched.strip():
+            _enrich_cache[key] = enriched
+            if len(_enrich_cache) > ENRICH_CACHE_SIZE:
+                _enrich_cache.popitem(last=False)
+    pending.set_result(enriched)
+    return enriched
+
+def clear_enrich_cache() -> None:
+    """Drop all cached refined prompts, e.g. after changing the enrich template or model."""
+    with _enrich_cache_lock:
+        _enrich_cache.clear()
+
+def _refine_prompt(latest_message: str, config: GenConfig) -> tuple[str, bool]:
+    """
+    Run the enrichment LLM call and extract the refined prompt.
+
+    Returns:
+        A tuple of (refined prompt, True), or (the full response, False) if it has no refined_prompt tag
+    """
     # Get response from model
-    llm = get_llm()
-    response = llm.create_chat_completion(
-        messages=[{"role": "user", "content": formatted_prompt}],
-        temperature=config.get('temperature', 0.6) if config else 0.6,
-        top_p=config.get('top_p', 0.95) if config else 0.95,
-        max_tokens=config.get('max_tokens', 32768) if config else 32768,
-    )
-    
-    response_text = response["choices"][0]["message"]["content"]
+    with acquire_llm() as llm:
+        # Only the user's message is tokenized per call; the template around it was tokenized by prepare_prompts()
+        prefix_tokens, suffix_tokens = _prompt_tokens["enrich"]
+        tokens = prefix_tokens + llm.tokenize(latest_message.encode("utf-8"), add_bos=False) + suffix_tokens
+        chunks = llm.create_completion(
+            prompt=tokens,
+            max_tokens=config.enrich_max_tokens,
+            **ENRICH_SAMPLER,
+            stop=["</refined_prompt>"],
+            stream=True,
+        )
+        response_text = _collect_stream(chunks)
 
-    # Extract content between &lt;refined_prompt&gt; tags
-    start_tag = "<refined_prompt>"
-    end_tag = "</refined_prompt>"
-    
-    start_idx = response_text.rfind(start_tag)
-    if start_idx == -1:
-        return response_text  # Return full response if no opening tag found
-    
-    # Get position after opening tag
-    content_start = start_idx + len(start_tag)
-    
-    # Look for closing tag
-    end_idx = response_text.find(end_tag, content_start)
+    # Extract content of the last &lt;refined_prompt&gt; tag, as the model may mention the tag while reasoning
+    start = response_text.rfind("<refined_prompt>")
+    if start == -1:
+        return response_text, False  # Return full response if no opening tag found
+    enriched = _tag_content(response_text, start + len("<refined_prompt>"), ("</refined_prompt>",))
     
-    enriched = ""
-    if end_idx == -1:
-        # No closing tag - return everything after opening tag
-        enriched = response_text[content_start:]
-    else:
-        # Return content between tags
-        enriched = response_text[content_start:end_idx]
-    
-    print("Original request:", latest_message)
-    print("Enriched response:", enriched)
-    return enriched
+    logger.debug("Original request: %s", latest_message)
+    logger.debug("Enriched response: %s", enriched)
+    return enriched, True
 
-def generate_expert(enriched_context: str, config: dict = None) -> str:
+def generate_expert(enriched_context: str, config: GenConfig = DEFAULT_SETTINGS) -> str:
     """
     Generate an expert persona based on enriched context by calling the LLM.
     
     Args:
         enriched_context: The enriched context to generate expert persona from
-        config: Optional configuration for the LLM call
+        config: Settings from load_settings()
         
     Returns:
         The ideal expert persona extracted from the LLM response
@@ -172,99 +726,43 @@ def generate_expert(enriched_context: str, config: dict = None) -> str:
     if not is_initialized():
         raise RuntimeError("Model not initialized. Call initialize() first.")
 
-    # Prompt template to generate expert persona
-    prompt_template = """<prompt>
-  <task>Analyze the following sample prompt thoughtfully and reflect on its characteristics to determine the best approach for answering it. **Think step by step and do a thorough job!**</task>
-  <instruction>
-    You are an expert in prompt analysis. Your goal is to understand the structure and intent of a given prompt so that you can identify its domain, the ideal expert to answer it, and the specific information needed for a comprehensive response. **Your detailed and accurate analysis is highly valued.**
-    MAKE SURE YOU RETURN THE INFORMATION IN XML FORMAT, specifically within the `<reflection_points>` tags.
-  </instruction>
-  <positive_encouragement>
-    We believe in your ability to provide a comprehensive and well-structured analysis. **Take your time and ensure accuracy in each step of your reasoning.**
-  </positive_encouragement>
-  <reward_system>
-    **You will be recognized for:**
-    <reward>Providing specific and well-justified answers for the domain and ideal expert.</reward>
-    <reward>Listing comprehensive and relevant types of needed information.</reward>
-    <reward>Ensuring your response is correctly formatted within the `<reflection_points>` XML structure.</reward>
-    **Accuracy and attention to detail will be highly rewarded in our assessment.**
-  </reward_system>
-  <chain_of_thought>
-    <step>First, carefully read and understand the content of the <sample_prompt> provided below.</step>
-    <step>Next, based on the keywords, concepts, and the nature of the question, determine the **primary domain** or subject area to which the sample prompt belongs. Consider fields like science, history, technology, literature, etc.</step>
-    <step>Then, think about the type of expertise required to provide a knowledgeable and accurate answer to the sample prompt. Identify the **specific type of expert** (e.g., a software engineer specializing in Python, a historian focused on the Roman Empire, a biologist studying genetics). Make sure the type of expert is well qualified, and could teach an advanced course in the subject matter. Make sure that you are only selecting ONE type of expert. If there multiple options, pick the best one. **Justify your choice with a clear and detailed explanation based directly on the content of the prompt.**</step>
-    <step>Finally, consider the kind of information that would be most relevant and necessary to construct a thorough and effective answer to the sample prompt. List the **specific types of information** that an expert would need to draw upon (e.g., definitions of key terms, historical dates, technical specifications, relevant theories, step-by-step procedures). **Be specific and consider the level of detail an expert in the field would need.**</step>
-    <step>Present your analysis by filling in the sections accurately and completely under <reflection_points>.</step>
-  </chain_of_thought>
-  <sample_prompt>
-    [SAMPLE PROMPT WILL BE INSERTED HERE BY THE USER]
-  </sample_prompt>
-  <hallucination_warning>
-    **It is critically important that you do not hallucinate or invent information.** Only provide analysis that is directly supported by your understanding of the sample prompt and general knowledge. If you are uncertain about any aspect, it is better to acknowledge the uncertainty than to provide potentially incorrect or fabricated details. **Accuracy is paramount.**
-  </hallucination_warning>
-  <reflection_points>
-    <domain>[To be filled by the LLM]</domain>
-    <ideal_expert>[To be filled by the LLM] (Justification: [To be filled by the LLM])</ideal_expert>
-    <needed_information>
-      <item>[To be filled by the LLM]</item>
-      <item>[To be filled by the LLM]</item>
-      <item>[To be filled by the LLM]</item>
-      <item>[To be filled by the LLM]</item>
-    </needed_information>
-  </reflection_points>
-</prompt>
-
-BELOW IS THE SAMPLE PROMPT: 
-
-{context}
-"""
-    
-    # Format the prompt with the enriched context
-    formatted_prompt = prompt_template.format(context=enriched_context)
-    
     # Get response from model
-    llm = get_llm()
-    response = llm.create_chat_completion(
-        messages=[{"role": "user", "content": formatted_prompt}],
-        temperature=config.get('temperature', 0.6) if config else 0.6,
-        top_p=config.get('top_p', 0.95) if config else 0.95,
-        max_tokens=config.get('max_tokens', 32768) if config else 32768,
-    )
-    
-    response_text = response["choices"][0]["message"]["content"]
-    
-    # First extract reflection_points block
-    reflection_start = response_text.rfind("<reflection_points>")
-    if reflection_start == -1:
-        print("Return empty if no reflection points found")
-        print("***")
-        print(response_text)
-        return ""  # Return empty if no reflection points found
-    
-    reflection_end = response_text.rfind("</reflection_points>", reflection_start)
-    if reflection_end == -1:
-        reflection_block = response_text[reflection_start:]
-    else:
-        reflection_block = response_text[reflection_start:reflection_end]
-    
-    # Then extract first ideal_expert from reflection block
-    expert_start = reflection_block.find("<ideal_expert>")
-    if expert_start == -1:
-        print("Return empty if no expert tag found")
-        print("***")
-        print(response_text)
-        return ""  # Return empty if no expert tag found
+    with acquire_llm() as llm:
+        # Only the enriched context is tokenized per call; the template around it was tokenized by prepare_prompts()
+        prefix_tokens, suffix_tokens = _prompt_tokens["expert"]
+        tokens = prefix_tokens + llm.tokenize(enriched_context.encode("utf-8"), add_bos=False) + suffix_tokens
+        chunks = llm.create_completion(
+            prompt=tokens,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            max_tokens=config.expert_max_tokens,
+            # The persona is the only part used, so generation ends with its element
+            stop=["</ideal_expert>"],
+            stream=True,
+        )
+        response_text = _collect_stream(chunks)
     
-    expert_end = reflection_block.find("</ideal_expert>", expert_start)
-    if expert_end == -1:
-        expert = reflection_block[expert_start + len("<ideal_expert>"):]
-        print(expert)
-        return expert
+    # Extract the first ideal_expert from the last reflection_points block
+    block = response_text.rfind("<reflection_points>")
+    start = response_text.find("<ideal_expert>", block) if block != -1 else -1
+    if start == -1:
+        logger.warning("No reflection points or expert tag found in: %s", response_text)
+        return ""  # Return empty if no reflection points or expert tag found
     
-    expert = reflection_block[expert_start + len("<ideal_expert>"):expert_end]
-    print("expert:", expert)
+    expert = _tag_content(response_text, start + len("<ideal_expert>"), ("</ideal_expert>", "</reflection_points>"))
+    logger.debug("expert: %s", expert)
     return expert
 
+def _tag_content(text: str, start: int, end_tags: tuple[str, ...]) -> str:
+    """
+    Return the text from start up to the first of end_tags, or to the end of text.
+
+    The generation stops on the closing tag and llama.cpp strips it, so the
+    unterminated case is the common one. Every scan is a linear str.find().
+    """
+    ends = [end for end in (text.find(tag, start) for tag in end_tags) if end != -1]
+    return text[start:min(ends)] if ends else text[start:]
+
 def build_final_prompt(enriched_content: str, expert_persona: str) -> str:
     """
     Combine enriched content and expert persona into a final prompt for the LLM.
@@ -276,43 +774,4 @@ def build_final_prompt(enriched_content: str, expert_persona: str) -> str:
     Returns:
         The final formatted prompt combining all components
     """
-    return f"""<prompt>
-  <context>
-    <description>You are tasked with providing a detailed explanation to the user's inquiry. Please focus on the core mechanisms and key aspects.</description>
-    <llm_guidance>As a smaller language model, we understand that your resources are limited. Therefore, we aim to provide a clear and concise prompt to help you deliver the best possible response.</llm_guidance>
-  </context>
-  <objective>
-    <goal>To generate a comprehensive and accurate explanation that demonstrates a strong understanding of its fundamental principles.</goal>
-  </objective>
-  <specificity>
-    <format_preference>Please structure your explanation in clear paragraphs, using bullet points if helpful to list key features or steps.</format_preference>
-  </specificity>
-  <persona>
-    {expert_persona}
-  </persona>
-  <task>
-    <action>Explain in detail the following:</action>
-    <topic>{enriched_content}</topic>
-  </task>
-  <resources_constraints>
-    <efficiency_focus>Please be as concise as possible while ensuring sufficient detail.</efficiency_focus>
-    <accuracy_emphasis>
-      <warning>
-        **It is absolutely critical that the information you provide is accurate and based on verifiable knowledge. Please do not generate or include any information that is fabricated, speculative, or constitutes a hallucination.** 
-      </warning>
-      <instruction>If you are uncertain about any aspect of the topic, please explicitly state your uncertainty rather than providing potentially incorrect information. </instruction>
-    </accuracy_emphasis>
-    <output_format_constraint>Your response should be formatted in well-structured paragraphs, potentially using bullet points for lists. Tables are also an option, if relevant and useful to the topic.</output_format_constraint>
-  </resources_constraints>
-  <reward_system>
-    <positive_reinforcement>A highly detailed, accurate, and well-explained response that adheres to these instructions and avoids any hallucinations will be considered a top-quality result. Such a response will be greatly appreciated and acknowledged as an excellent demonstration of your capabilities.</positive_reinforcement> 
-    <quality_criteria>Key indicators of a high-quality response include:</quality_criteria>
-    <ul>
-      <li>Demonstrated in-depth understanding of the topic.</li>
-      <li>Accuracy of all provided information.</li>
-      <li>Clarity and logical flow of the explanation.</li>
-      <li>Appropriate level of detail without being overly verbose.</li>
-      <li>Complete absence of hallucinations or fabricated information.</li>
-    </ul>
-  </reward_system>
-</prompt>"""
+    return _FINAL_HEAD + expert_persona + _FINAL_MIDDLE + enriched_content + _FINAL_TAIL
@@ -1,4 +1,9 @@
-import json
+import asyncio
+import atexit
+import logging
+import logging.handlers
+import orjson
+import queue
 import time
 import uuid
 import yaml # Added for config loading
@@ -6,12 +11,14 @@ import sys  # Added for error handling exit
 from typing import List, Optional
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from pydantic import BaseModel, Field
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from enrichr import enrich_request
+from starlette.concurrency import iterate_in_threadpool
+from enrichr import ChatMessageInput, enrich_request, stream_enrich_request, prepare_prompts, load_settings
 from model import initialize
+import semantic_cache
 
 # --- Load Configuration ---
 
@@ -20,7 +27,8 @@ config = {}
 
 try:
     with open(CONFIG_PATH, 'r') as f:
-        config = yaml.safe_load(f)
+        # libyaml-backed loader when PyYAML was built with it
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
     print(f"Configuration loaded successfully from {CONFIG_PATH}")
     # Basic validation (optional, can be expanded)
     if not config or 'model_path' not in config:
@@ -37,16 +45,33 @@ except Exception as e:
     print(f"An unexpected error occurred while loading configuration: {e}. Exiting.", file=sys.stderr)
     sys.exit(1)
 
+# --- Logging ---
+
+# Request threads only enqueue records and a listener thread does the stream I/O,
+# so a slow stdout never blocks the request path. QueueHandler.prepare() still
+# merges the message arguments and any traceback in the calling thread; the
+# timestamp, level and logger name are added by the listener's formatter.
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=config.get('log_level', 'INFO'), handlers=[queue_handler])
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
+# Request-path settings, resolved once so handlers avoid per-call config lookups
+settings = load_settings(config)
 
-# --- Pydantic Models (Based on PLAN.md Section 4) ---
 
-class ChatMessageInput(BaseModel):
-    role: str
-    content: str
+# --- Pydantic Models (Based on PLAN.md Section 4) ---
 
 class ChatCompletionRequest(BaseModel):
     messages: List[ChatMessageInput]
     model: Optional[str] = None # Make model optional for flexibility
+    stream: bool = False
     # Add other fields as needed for strict compatibility if required by client
 
 class ChatMessageOutput(BaseModel):
@@ -69,19 +94,18 @@ class ChatCompletionResponse(BaseModel):
 
 # --- FastAPI Application ---
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Initialize the model with config
 print(f"Initializing model with config: {config}")
+# model.py owns the one shared set of Llama handles; initialize() loads them
+# synchronously and exits on failure, so there is nothing to wait for
 initialize(config)
-
-# Wait for model to fully initialize
-from model import is_initialized
-while not is_initialized():
-    print("Waiting for model initialization to complete...")
-    time.sleep(1)
+prepare_prompts()
 print("Model initialization complete")
 
+semantic_cache.initialize(config)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -95,22 +119,19 @@ app.add_middleware(
 # --- API Endpoint ---
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, raw_request: Request):
+async def chat_completions(request: ChatCompletionRequest):
     """
     OpenAI-compatible chat completions endpoint.
     Receives messages, prints them, and returns a static response.
     Uses configuration loaded at startup.
     """
-    print("Received messages:")
-    for message in request.messages:
-        print(f"- Role: {message.role}, Content: {message.content}")
-    
-    # Log raw request for debugging
-    body = await raw_request.json()
-    print(f"Raw request body: {body}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received messages:")
+        for message in request.messages:
+            logger.debug("- Role: %s, Content: %s", message.role, message.content)
 
     try:
-        if body.get('stream', False):
+        if request.stream:
             # Handle streaming response
             async def stream_response():
                 response_id = f"chatcmpl-{uuid.uuid4()}"
@@ -128,12 +149,17 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
                         "finish_reason": None
                     }]
                 }
-                yield f"data: {json.dumps(chunk)}\n\n"
+                yield f"data: {orjson.dumps(chunk).decode()}\n\n"
                 
+                # The pipeline generator blocks on the model, so each step runs in a worker thread
+                texts = stream_enrich_request(request.messages, settings)
                 try:
-                    formatted_messages, response_text = enrich_request(request.messages, config)
+                    # Forward the final stage's output as it is generated
+                    async for text in iterate_in_threadpool(texts):
+                        chunk["choices"][0]["delta"] = {"content": text}
+                        yield f"data: {orjson.dumps(chunk).decode()}\n\n"
                 except Exception as e:
-                    print(f"Error processing request: {e}")
+                    logger.exception("Error processing request: %s", e)
                     chunk = {
                         "id": f"chatcmpl-{uuid.uuid4()}",
                         "object": "chat.completion.chunk",
@@ -147,12 +173,16 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
                             "finish_reason": "error"
                         }]
                     }
-                    yield f"data: {json.dumps(chunk)}\n\n"
+                    yield f"data: {orjson.dumps(chunk).decode()}\n\n"
                     yield "data: [DONE]\n\n"
                     return
-                # Send the content in a separate chunk
-                chunk["choices"][0]["delta"] = {"content": response_text}
-                yield f"data: {json.dumps(chunk)}\n\n"
+                finally:
+                    # Releases the model handle if the client disconnected mid-stream
+                    texts.close()
+                # Mark the end of the content
+                chunk["choices"][0]["delta"] = {}
+                chunk["choices"][0]["finish_reason"] = "stop"
+                yield f"data: {orjson.dumps(chunk).decode()}\n\n"
                 
                 # Send the done message
                 yield "data: [DONE]\n\n"
@@ -164,7 +194,8 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
         else:
             # Non-streaming response (unchanged)
             try:
-                formatted_messages, response_text = enrich_request(request.messages, config)
+                # Run the blocking pipeline in a worker thread so the event loop keeps serving
+                formatted_messages, response_text = await asyncio.to_thread(enrich_request, request.messages, settings)
                 response = {
                     "id": f"chatcmpl-{uuid.uuid4()}",
                     "object": "chat.completion",
@@ -179,16 +210,16 @@ async def chat_completions(request: ChatCompletionRequest, raw_request: Request)
                     }],
                     "model": "default-model-v1"
                 }
-                return JSONResponse(content=response)
+                return ORJSONResponse(content=response)
             except Exception as e:
-                print(f"Error processing request: {e}")
-                return JSONResponse(
+                logger.exception("Error processing request: %s", e)
+                return ORJSONResponse(
                     status_code=500,
                     content={"error": str(e)}
                 )
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception("Error: %s", e)
         raise
         print(f"Error creating response: {e}")
         raise e from None
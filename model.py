@@ -1,34 +1,213 @@
-from llama_cpp import Llama
+from contextlib import contextmanager
+from llama_cpp import Llama, LlamaDiskCache, LlamaRAMCache
+import hashlib
+import llama_cpp
 import os
+import queue
 import sys
 
 # Global model instance
 llm = None
 
+# KV cache storage types by config name. q8_0 halves and q4_0 quarters the
+# attention bandwidth and cache size of f16.
+KV_TYPES = {
+    'f16': llama_cpp.GGML_TYPE_F16,
+    'q8_0': llama_cpp.GGML_TYPE_Q8_0,
+    'q4_0': llama_cpp.GGML_TYPE_Q4_0,
+}
+
+# NUMA placement strategies by config name, for multi-socket hosts
+NUMA_STRATEGIES = {
+    'disabled': llama_cpp.GGML_NUMA_STRATEGY_DISABLED,
+    'distribute': llama_cpp.GGML_NUMA_STRATEGY_DISTRIBUTE,
+    'isolate': llama_cpp.GGML_NUMA_STRATEGY_ISOLATE,
+    'numactl': llama_cpp.GGML_NUMA_STRATEGY_NUMACTL,
+}
+
+# Pool of model handles (including llm) that can each serve one call at a time
+handles = queue.Queue()
+n_handles = 0
+
+def _load_model(config: dict) -> Llama:
+    """Load one model handle from configuration, falling back to CPU if GPU offload fails."""
+    n_gpu_layers = config.get('n_gpu_layers', -1)
+    try:
+        model = _create_llama(config, n_gpu_layers)
+    except Exception as e:
+        if n_gpu_layers == 0:
+            raise
+        # Typically not enough VRAM for the requested layers; partial offload
+        # is often slower than pure CPU, so drop straight to CPU
+        print(f"Warning: Loading model with n_gpu_layers={n_gpu_layers} failed ({e}). "
+              "Retrying on CPU only.", file=sys.stderr)
+        model = _create_llama(config, 0)
+    if config.get('warmup', True):
+        _warm_up(model)
+    # Keep KV state for recent prompts so the static template prefixes
+    # shared across calls are restored instead of re-evaluated
+    prompt_cache = _create_prompt_cache(config)
+    if prompt_cache is not None:
+        model.set_cache(prompt_cache)
+    return model
+
+def _prompt_cache_mode(config: dict) -> str:
+    """
+    Resolve 'prompt_cache' (none, ram or disk), defaulting to ram in deep mode and none otherwise.
+
+    Every completion on a cached handle snapshots the context state and the
+    batch logits on the request thread. That only pays off in deep mode,
+    where the stages alternate between different prompts on a handle; in
+    single-call mode every request starts with the same system prompt, whose
+    KV prefix the live context already reuses.
+    """
+    return config.get('prompt_cache', 'ram' if config.get('deep_mode', False) else 'none')
+
+def _create_prompt_cache(config: dict):
+    """Create the prompt KV cache selected by 'prompt_cache', or None when it is disabled."""
+    mode = _prompt_cache_mode(config)
+    if mode == 'none':
+        return None
+    capacity_bytes = config.get('prompt_cache_bytes', 2 << 30)
+    if mode == 'disk':
+        # Survives restarts, so the template prefixes are warm from the first request.
+        # Entries are keyed by tokens alone, so each model file and KV type gets its
+        # own subdirectory and never restores state written by a different model.
+        return LlamaDiskCache(
+            cache_dir=os.path.join(config.get('prompt_cache_dir', '.prompt_cache'), _model_fingerprint(config)),
+            capacity_bytes=capacity_bytes,
+        )
+    return LlamaRAMCache(capacity_bytes=capacity_bytes)
+
+def _model_fingerprint(config: dict) -> str:
+    """Identify the model file and KV cache type whose state a prompt cache holds."""
+    model_path = os.path.abspath(config['model_path'])
+    stat = os.stat(model_path)
+    identity = f"{model_path}:{stat.st_size}:{stat.st_mtime_ns}:{config.get('kv_type', 'q8_0')}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+
+def _create_llama(config: dict, n_gpu_layers: int) -> Llama:
+    """Construct a Llama instance with the given number of offloaded layers."""
+    kv_type = KV_TYPES[config.get('kv_type', 'q8_0')]
+    return Llama(
+        model_path=config['model_path'],
+        n_ctx=config['n_ctx'],
+        n_gpu_layers=n_gpu_layers,
+        tensor_split=config.get('tensor_split'),
+        main_gpu=config.get('main_gpu', 0),
+        offload_kqv=True,
+        n_threads=config.get('n_threads', max(1, (os.cpu_count() or 2) // 2)),
+        n_batch=config.get('n_batch', 512),
+        n_ubatch=config.get('n_ubatch', 512),
+        # llama.cpp only supports a quantized V cache with flash attention
+        flash_attn=config.get('flash_attn', True) or kv_type != llama_cpp.GGML_TYPE_F16,
+        type_k=kv_type,
+        type_v=kv_type,
+        # Map the weights read-only so every handle shares one copy in the page cache,
+        # and lock them resident so decode never stalls on a page fault
+        use_mmap=config.get('use_mmap', True),
+        use_mlock=config.get('use_mlock', True),
+        numa=NUMA_STRATEGIES[config.get('numa', 'disabled')],
+    )
+
+def _warm_up(model: Llama) -> None:
+    """
+    Run a one-token generation so the first request does not pay for lazy setup.
+
+    The first decode triggers CUDA context creation, kernel selection and
+    buffer allocation, which can stall a request for seconds.
+    """
+    model.create_completion("a", max_tokens=1, temperature=0.0)
+    model.reset()
+
+def _report_offload(model: Llama, config: dict) -> None:
+    """Log how many layers ended up on the GPU, warning when the build cannot offload at all."""
+    if not llama_cpp.llama_supports_gpu_offload():
+        if config.get('n_gpu_layers', -1) != 0:
+            print("Warning: This llama-cpp-python build has no GPU offload support, so every layer runs on CPU. "
+                  "Rebuild it with CUDA enabled (see README.md).", file=sys.stderr)
+        return
+    architecture = model.metadata.get("general.architecture", "")
+    n_layers = int(model.metadata.get(f"{architecture}.block_count", 0))
+    # -1 is stored as INT_MAX, so min() covers both "all" and explicit counts
+    offloaded = min(model.model_params.n_gpu_layers, n_layers)
+    print(f"Offloaded {offloaded}/{n_layers} layers to GPU")
+    if offloaded == 0:
+        print("Warning: No layers are offloaded to GPU; generation will be much slower.", file=sys.stderr)
+
+# GGUF general.file_type values of unquantized weights
+UNQUANTIZED_FILE_TYPES = {0: 'F32', 1: 'F16', 32: 'BF16'}
+
+def _check_quantization(model: Llama) -> None:
+    """Warn when the weights are unquantized, since decode speed is bound by the bytes read per token."""
+    file_type = UNQUANTIZED_FILE_TYPES.get(int(model.metadata.get("general.file_type", -1)))
+    if file_type is not None:
+        print(f"Warning: The model weights are {file_type}. A Q4_K_M or Q5_K_M quantization reads roughly "
+              "a quarter to a third of the bytes per token and decodes correspondingly faster.", file=sys.stderr)
+
+def _cpu_has_vnni() -> bool:
+    """Check whether this CPU supports AVX512_VNNI (Linux only; False where it cannot be determined)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            return any(line.startswith("flags") and "avx512_vnni" in line.split() for line in f)
+    except OSError:
+        return False
+
+def _check_build() -> None:
+    """Log the llama.cpp build features and warn if the CPU's int8 dot-product path is not compiled in."""
+    system_info = llama_cpp.llama_print_system_info().decode("utf-8", errors="replace")
+    print(f"llama.cpp system info: {system_info}")
+    # Only actionable when the CPU has the instructions; ARM, Apple and older x86 never report it
+    if "AVX512_VNNI = 1" not in system_info and _cpu_has_vnni():
+        print("Warning: llama.cpp was built without AVX512_VNNI; quantized CPU layers will be slower. "
+              "See README.md for the rebuild flags.", file=sys.stderr)
+
 def initialize(config: dict) -> None:
     """Initialize the LLM model with configuration."""
-    global llm
+    global llm, n_handles
     
     # Validate required config parameters
-    required_keys = ['model_path', 'n_ctx', 'n_gpu_layers']
+    required_keys = ['model_path', 'n_ctx']
     for key in required_keys:
         if key not in config:
             print(f"Error: Missing required config key '{key}'. Exiting.", file=sys.stderr)
             sys.exit(1)
     
+    if config.get('kv_type', 'q8_0') not in KV_TYPES:
+        print(f"Error: Unsupported kv_type '{config['kv_type']}' (expected one of {', '.join(KV_TYPES)}). Exiting.", file=sys.stderr)
+        sys.exit(1)
+    if config.get('kv_type', 'q8_0') != 'f16' and not config.get('flash_attn', True):
+        print("Warning: A quantized KV cache requires flash attention; enabling 'flash_attn'.", file=sys.stderr)
+    
+    if config.get('numa', 'disabled') not in NUMA_STRATEGIES:
+        print(f"Error: Unsupported numa '{config['numa']}' (expected one of {', '.join(NUMA_STRATEGIES)}). Exiting.", file=sys.stderr)
+        sys.exit(1)
+    
+    if _prompt_cache_mode(config) not in ('none', 'ram', 'disk'):
+        print(f"Error: Unsupported prompt_cache '{config['prompt_cache']}' (expected none, ram or disk). Exiting.", file=sys.stderr)
+        sys.exit(1)
+    
     # Verify model file exists
     if not os.path.exists(config['model_path']):
         print(f"Error: Model file not found at '{config['model_path']}'. Exiting.", file=sys.stderr)
         sys.exit(1)
     
     try:
+        _check_build()
         print(f"Initializing model with path: {config['model_path']}")
-        llm = Llama(
-            model_path=config['model_path'],
-            n_ctx=config['n_ctx'],
-            n_gpu_layers=config['n_gpu_layers']
-        )
-        print("Model initialized successfully")
+        llm = _load_model(config)
+        _report_offload(llm, config)
+        _check_quantization(llm)
+        handles.put(llm)
+
+        # Extra handles share the mmap'd weights; each gets its own KV cache
+        for _ in range(config.get('n_parallel', 1) - 1):
+            handles.put(_load_model(config))
+        n_handles = handles.qsize()
+        print(f"Model initialized successfully with {n_handles} handle(s)")
+        if config.get('speculative_expert', False) and n_handles < 2:
+            print("Warning: 'speculative_expert' needs 'n_parallel' of at least 2; "
+                  "the enrich and expert stages will run one after the other.", file=sys.stderr)
     except Exception as e:
         print(f"Error initializing model: {e}. Exiting.", file=sys.stderr)
         sys.exit(1)
@@ -43,4 +222,25 @@ def get_llm():
     global llm
     if not is_initialized():
         raise RuntimeError("Model not initialized")
-    return llm
\ No newline at end of file
+    return llm
+
+def pool_size() -> int:
+    """Get the number of model handles that can serve calls concurrently."""
+    global n_handles
+    return n_handles
+
+@contextmanager
+def acquire_llm():
+    """
+    Borrow a model handle for the duration of one LLM call.
+
+    A Llama instance is not reentrant, so every call must hold a handle
+    exclusively. Blocks until one is free.
+    """
+    if not is_initialized():
+        raise RuntimeError("Model not initialized")
+    handle = handles.get()
+    try:
+        yield handle
+    finally:
+        handles.put(handle)
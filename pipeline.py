@@ -1,31 +1,43 @@
-def execute(request: List['ChatMessageInput'], config: dict = None) -> tuple[List['ChatMessageInput'], str]:
+import asyncio
+from typing import Any, Awaitable, Callable, List
+
+Stage = Callable[[List['ChatMessageInput'], dict], Awaitable[tuple[List['ChatMessageInput'], str]]]
+
+async def execute(request: List['ChatMessageInput'], config: dict = None) -> tuple[List['ChatMessageInput'], str]:
     """Execute the chat completion pipeline with the given request and config.
-    
+
+    The configured stages are independent of each other, so they all run
+    concurrently on the same request.
+
     Args:
         request: List of chat message input objects
         config: Configuration object for the pipeline
-        
+
     Returns:
         tuple: A tuple containing (updated messages, processed result)
     """
-    pass
-
-from typing import Callable, List
+    stages = config_pipeline(config)
+    if not stages:
+        return request, ""
+    results = await asyncio.gather(*(stage(request, config) for stage in stages))
+    # Messages come from the last stage; the results are joined in stage order
+    messages = results[-1][0]
+    return messages, "".join(result for _, result in results)
 
-def config_pipeline(pipelineconfig: dict = None) -> List[Callable[[List['ChatMessageInput'], dict], tuple[List['ChatMessageInput'], str]]]:
+def config_pipeline(pipelineconfig: dict = None) -> List[Stage]:
     """Configure the pipeline with the given configuration.
-    
+
     Args:
         pipelineconfig: Configuration object for setting up the pipeline
-        
+
     Returns:
-        List[Callable]: List of functions matching the execute function signature
+        List[Stage]: List of async functions matching the execute function signature
     """
     # Return a list of functions that match execute's signature
-    def func1(request: List['ChatMessageInput'], config: Any) -> tuple[List['ChatMessageInput'], str]:
+    async def func1(request: List['ChatMessageInput'], config: Any) -> tuple[List['ChatMessageInput'], str]:
         return request, ""
-        
-    def func2(request: List['ChatMessageInput'], config: Any) -> tuple[List['ChatMessageInput'], str]:
+
+    async def func2(request: List['ChatMessageInput'], config: Any) -> tuple[List['ChatMessageInput'], str]:
         return request, ""
-        
-    return [func1, func2]
\ No newline at end of file
+
+    return [func1, func2]
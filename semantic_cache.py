@@ -0,0 +1,235 @@
+from llama_cpp import Llama
+import atexit
+import hashlib
+import logging
+import numpy as np
+import os
+import pickle
+import sys
+import threading
+from model import acquire_llm
+
+logger = logging.getLogger(__name__)
+
+# Global cache instance
+cache = None
+
+class SemanticCache:
+    """
+    Embedding-similarity cache of final pipeline responses.
+
+    Entries are keyed on the latest user message and only match requests with
+    the same prior conversation. Lookups are a two-stage check: a similarity at
+    or above hit_threshold is returned directly, a similarity between
+    verify_threshold and hit_threshold is confirmed with a short LLM call, and
+    anything lower is a miss.
+
+    Entries live in a preallocated ring of capacity rows, overwriting the
+    oldest when full. New entries are persisted by a background thread every
+    save_interval seconds and on close(), never on the request path.
+    """
+
+    def __init__(self, model_path: str, cache_path: str = None,
+                 hit_threshold: float = 0.95, verify_threshold: float = 0.85,
+                 capacity: int = 10000, save_interval: float = 60.0):
+        self.embedder = Llama(model_path=model_path, embedding=True, verbose=False)
+        self.cache_path = cache_path
+        self.hit_threshold = hit_threshold
+        self.verify_threshold = verify_threshold
+        self.capacity = capacity
+
+        # Vectors are only comparable with those of the same embedding model
+        stat = os.stat(model_path)
+        self.fingerprint = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns, self.embedder.n_embd())
+
+        # Ring buffer: row i of vectors is the embedding of prompts[i], asked after
+        # the conversation whose hash is context_ids[i]. The first count rows are
+        # filled and the next entry is written at row head.
+        self.prompts = [None] * capacity
+        self.responses = [None] * capacity
+        self.vectors = np.zeros((capacity, self.embedder.n_embd()), dtype=np.float32)
+        self.context_ids = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.head = 0
+
+        # Requests run in worker threads; guards the ring buffer
+        self.lock = threading.Lock()
+        # The embedder is not reentrant, but embedding must not hold up lookups
+        self.embed_lock = threading.Lock()
+        # Serializes writers of the cache file
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.closed = threading.Event()
+
+        if cache_path and os.path.exists(cache_path):
+            self._load()
+        if cache_path:
+            threading.Thread(target=self._persist, args=(save_interval,), daemon=True).start()
+
+    def embed(self, text: str) -> np.ndarray:
+        """Embed text as a normalized FP32 vector so inner product is cosine similarity."""
+        with self.embed_lock:
+            vec = np.asarray(self.embedder.embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    @staticmethod
+    def _context_id(context: str) -> int:
+        """Hash the prior conversation into a 64-bit id."""
+        return int.from_bytes(hashlib.blake2b(context.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+    def lookup(self, prompt: str, context: str = "", vector: np.ndarray = None):
+        """
+        Find a cached response for a semantically equivalent prompt.
+
+        Args:
+            prompt: The latest user message
+            context: The conversation before the latest message, as a string
+            vector: The prompt's embed() vector, if the caller already has it
+
+        Returns:
+            The cached response, or None on a miss
+        """
+        if vector is None:
+            vector = self.embed(prompt)
+        context_id = self._context_id(context)
+        with self.lock:
+            if self.count == 0:
+                return None
+
+            similarities = self.vectors[:self.count] @ vector
+            # The same words mean something else after a different conversation
+            similarities[self.context_ids[:self.count] != context_id] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            cached_prompt = self.prompts[best]
+            cached_response = self.responses[best]
+
+        if similarity >= self.hit_threshold:
+            logger.debug("Semantic cache hit (similarity %.3f)", similarity)
+            return cached_response
+        if similarity >= self.verify_threshold and self._verify(cached_prompt, prompt):
+            logger.debug("Semantic cache verified hit (similarity %.3f)", similarity)
+            return cached_response
+        return None
+
+    def add(self, prompt: str, response, context: str = "", vector: np.ndarray = None) -> None:
+        """Store a response for a prompt asked after the given conversation, overwriting the oldest entry when full."""
+        if vector is None:
+            vector = self.embed(prompt)
+        with self.lock:
+            self._put(prompt, response, self._context_id(context), vector)
+            self.dirty = True
+
+    def _put(self, prompt: str, response, context_id: int, vector: np.ndarray) -> None:
+        """Write one entry at the head of the ring. Caller holds the lock."""
+        row = self.head
+        self.vectors[row] = vector
+        self.context_ids[row] = context_id
+        self.prompts[row] = prompt
+        self.responses[row] = response
+        self.head = (row + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _verify(self, cached_prompt: str, prompt: str) -> bool:
+        """Ask the main model whether two borderline-similar requests are equivalent."""
+        question = (
+            "Do the following two requests ask for exactly the same thing? "
+            "Answer only YES or NO.\n\n"
+            f"Request A: {cached_prompt}\n\n"
+            f"Request B: {prompt}"
+        )
+        with acquire_llm() as llm:
+            response = llm.create_chat_completion(
+                messages=[{"role": "user", "content": question}],
+                temperature=0.0,
+                max_tokens=2,
+            )
+        answer = response["choices"][0]["message"]["content"]
+        return answer.strip().upper().startswith("YES")
+
+    def close(self) -> None:
+        """Stop the background writer and persist any entries added since the last save."""
+        self.closed.set()
+        if self.cache_path:
+            self.save()
+
+    def save(self) -> None:
+        """Write the cache to cache_path if it changed since the last save."""
+        with self.lock:
+            if not self.dirty:
+                return
+            # Oldest entry first, so a reload refills the ring in the same order
+            order = [(self.head - self.count + i) % self.capacity for i in range(self.count)]
+            data = {
+                "fingerprint": self.fingerprint,
+                "prompts": [self.prompts[i] for i in order],
+                "responses": [self.responses[i] for i in order],
+                "vectors": self.vectors[order],
+                "context_ids": self.context_ids[order],
+            }
+            self.dirty = False
+        try:
+            with self.save_lock:
+                tmp_path = f"{self.cache_path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(data, f)
+                os.replace(tmp_path, self.cache_path)
+        except Exception:
+            # Retry on the next save
+            with self.lock:
+                self.dirty = True
+            raise
+
+    def _persist(self, save_interval: float) -> None:
+        """Background loop saving new entries periodically, off the request path."""
+        while not self.closed.wait(save_interval):
+            try:
+                self.save()
+            except Exception as e:
+                logger.warning("Could not save semantic cache to '%s': %s", self.cache_path, e)
+
+    def _load(self) -> None:
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get("fingerprint") != self.fingerprint:
+                # Written by another embedding model or an older format; its similarities would be meaningless
+                print(f"Warning: Discarding semantic cache entries in '{self.cache_path}' written by a different "
+                      "embedding model or an older format", file=sys.stderr)
+                return
+            entries = zip(data["prompts"], data["responses"], data["context_ids"], data["vectors"])
+            for prompt, response, context_id, vector in list(entries)[-self.capacity:]:
+                self._put(prompt, response, int(context_id), vector)
+            print(f"Loaded {self.count} semantic cache entries from {self.cache_path}")
+        except Exception as e:
+            print(f"Warning: could not load semantic cache from '{self.cache_path}': {e}", file=sys.stderr)
+
+def initialize(config: dict) -> None:
+    """Initialize the semantic cache if an embedding model is configured."""
+    global cache
+
+    model_path = config.get('semantic_cache_model_path')
+    if not model_path:
+        print("Semantic cache disabled (no 'semantic_cache_model_path' configured)")
+        return
+
+    if not os.path.exists(model_path):
+        print(f"Error: Embedding model file not found at '{model_path}'. Exiting.", file=sys.stderr)
+        sys.exit(1)
+
+    cache = SemanticCache(
+        model_path=model_path,
+        cache_path=config.get('semantic_cache_path'),
+        hit_threshold=config.get('semantic_cache_hit_threshold', 0.95),
+        verify_threshold=config.get('semantic_cache_verify_threshold', 0.85),
+        capacity=config.get('semantic_cache_size', 10000),
+        save_interval=config.get('semantic_cache_save_interval', 60.0),
+    )
+    atexit.register(cache.close)
+    print("Semantic cache initialized successfully")
+
+def get_cache():
+    """Get the semantic cache instance, or None if it is disabled."""
+    global cache
+    return cache